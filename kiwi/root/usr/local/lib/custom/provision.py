@@ -1,34 +1,58 @@
 #!/usr/bin/env python3
 # Copyright (c) 2025 Darren Soothill
 """First boot provisioning helper for the custom KIWI image."""
-"""First boot provisioning helper for the custom KIWI image."""
-"""First boot provisioning helper for the custom KIWI image."""
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
 import os
 import pwd
 import grp
 import shutil
+import stat
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from socket import timeout
 from urllib.error import HTTPError, URLError
 from urllib.request import Request, urlopen
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib decoder is used instead
+    orjson = None
+
+
+# shadow-utils tools fail rather than wait when another instance holds the
+# passwd/group lock, so account changes are serialised across worker threads.
+_ACCOUNT_LOCK = threading.Lock()
+
+KEY_CACHE_DIR = Path("/var/cache/custom-provision/keys")
+KEY_CACHE_TTL = 300
+
 
 def read_config(config_path: Path) -> Dict:
+    if orjson is not None:
+        return orjson.loads(config_path.read_bytes())
     with config_path.open("r", encoding="utf-8") as handle:
         return json.load(handle)
 
 
-def ensure_group(name: str) -> None:
+def _group_exists(name: str) -> bool:
     try:
         grp.getgrnam(name)
     except KeyError:
+        return False
+    return True
+
+
+def ensure_group(name: str) -> None:
+    if not _group_exists(name):
         subprocess.run(["groupadd", "-f", name], check=True)
 
 
@@ -47,7 +71,7 @@ def set_user_password(username: str, password: str, hashed: bool = False) -> Non
         print(f"Failed to set password for {username}: {exc}", file=sys.stderr)
 
 
-def ensure_user(user: Dict) -> None:
+def ensure_user(user: Dict, extra_groups: List[str]) -> None:
     username = user["username"]
     gecos = user.get("gecos", username)
     shell = user.get("shell", "/bin/bash")
@@ -66,146 +90,263 @@ def ensure_user(user: Dict) -> None:
     if isinstance(gid, int):
         useradd_cmd.extend(["-g", str(gid)])
 
-    useradd_cmd.append(username)
-
-    try:
-        pwd.getpwnam(username)
-        user_exists = True
-    except KeyError:
-        user_exists = False
+    if extra_groups:
+        useradd_cmd.extend(["-G", ",".join(extra_groups)])
 
-    if not user_exists:
-        subprocess.run(useradd_cmd, check=True)
+    useradd_cmd.append(username)
 
-    subprocess.run(["usermod", "-aG", "sudo", username], check=True)
+    with _ACCOUNT_LOCK:
+        try:
+            user_info: Optional[pwd.struct_passwd] = pwd.getpwnam(username)
+        except KeyError:
+            user_info = None
 
-    wheel_group = "wheel"
-    try:
-        grp.getgrnam(wheel_group)
-    except KeyError:
-        wheel_group = None
-    if wheel_group:
-        subprocess.run(["usermod", "-aG", wheel_group, username], check=True)
+        if user_info is None:
+            subprocess.run(useradd_cmd, check=True)
+            user_info = pwd.getpwnam(username)
+        elif extra_groups:
+            subprocess.run(["usermod", "-aG", ",".join(extra_groups), username], check=True)
 
-    password = user.get("password")
-    if isinstance(password, str) and password:
-        hashed = bool(user.get("password_is_hashed"))
-        set_user_password(username, password, hashed)
+        password = user.get("password")
+        if isinstance(password, str) and password:
+            hashed = bool(user.get("password_is_hashed"))
+            set_user_password(username, password, hashed)
 
     authorized_keys = collect_authorized_keys(user)
     if authorized_keys:
-        install_authorized_keys(username, authorized_keys)
+        install_authorized_keys(user_info, authorized_keys)
 
 
-def collect_authorized_keys(user: Dict) -> List[str]:
-    collected: List[str] = []
-    seen: Set[str] = set()
+def _key_source_url(source: Dict) -> Optional[str]:
+    source_type = source.get("type")
+    if source_type == "user":
+        username = source["user"]
+        return f"https://github.com/{username}.keys"
+    if source_type == "repo":
+        owner = source["owner"]
+        repo = source["repo"]
+        path = source["path"]
+        ref = source.get("ref", "main")
+        return f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}"
+    if source_type == "url":
+        return source["url"]
+    return None
 
+
+def collect_authorized_keys(user: Dict) -> List[str]:
+    pending: List[Tuple[Dict, str]] = []
     for source in user.get("github_keys", []):
         if not isinstance(source, dict):
             continue
-        source_type = source.get("type")
         try:
-            if source_type == "user":
-                username = source["user"]
-                url = f"https://github.com/{username}.keys"
-                keys = fetch_remote_keys(url)
-            elif source_type == "repo":
-                owner = source["owner"]
-                repo = source["repo"]
-                path = source["path"]
-                ref = source.get("ref", "main")
-                url = f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}"
-                keys = fetch_remote_keys(url)
-            elif source_type == "url":
-                url = source["url"]
-                keys = fetch_remote_keys(url)
-            else:
-                continue
+            url = _key_source_url(source)
         except KeyError as exc:
             source_desc = json.dumps(source, sort_keys=True)
             print(f"Skipping malformed GitHub key source {source_desc}: {exc}", file=sys.stderr)
             continue
-        except RuntimeError as exc:
-            source_desc = json.dumps(source, sort_keys=True)
-            print(f"Unable to fetch keys from {source_desc}: {exc}", file=sys.stderr)
-        except (KeyError, RuntimeError):
-            continue
+        if url:
+            pending.append((source, url))
 
-        for key in keys:
-            if key and key not in seen:
-                seen.add(key)
-                collected.append(key)
+    collected: List[str] = []
+    seen: Set[str] = set()
+    if not pending:
+        return collected
+
+    # Sources that resolve to the same URL share a single download.
+    urls = list(dict.fromkeys(url for _, url in pending))
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as executor:
+        futures = {url: executor.submit(_fetch_cached, url) for url in urls}
+        # Consume results in source order so the key order stays deterministic.
+        for source, url in pending:
+            try:
+                keys = futures[url].result()
+            except RuntimeError as exc:
+                source_desc = json.dumps(source, sort_keys=True)
+                print(f"Unable to fetch keys from {source_desc}: {exc}", file=sys.stderr)
+                continue
+
+            for key in keys:
+                if key and key not in seen:
+                    seen.add(key)
+                    collected.append(key)
 
     return collected
 
 
-def fetch_remote_keys(url: str) -> List[str]:
-    request = Request(url, headers={"User-Agent": "custom-kiwi-builder/1.0"})
+def _read_cache(path: Path, max_age: Optional[float] = None) -> Optional[str]:
+    try:
+        if max_age is not None and time.time() - path.stat().st_mtime > max_age:
+            return None
+        return path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+
+
+def _write_cache(path: Path, text: str) -> None:
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        print(f"Unable to update key cache {path}: {exc}", file=sys.stderr)
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+
+
+def _download_keys(url: str, cache_path: Path, etag_path: Path) -> str:
+    headers = {"User-Agent": "custom-kiwi-builder/1.0"}
+    cached = _read_cache(cache_path)
+    etag = _read_cache(etag_path) if cached is not None else None
+    if etag:
+        headers["If-None-Match"] = etag.strip()
+
+    request = Request(url, headers=headers)
     try:
         with urlopen(request, timeout=15) as response:
             body = response.read().decode("utf-8")
-    except (HTTPError, URLError, TimeoutError, timeout) as exc:
+            etag = response.headers.get("ETag")
+    except HTTPError as exc:
+        if exc.code == 304 and cached is not None:
+            try:
+                os.utime(cache_path)
+            except OSError:
+                pass
+            return cached
         raise RuntimeError(f"Failed to fetch keys from {url}: {exc}") from exc
+    except (URLError, TimeoutError, timeout) as exc:
+        # Only transport failures fall back to stale keys; an HTTP error such
+        # as 404 means the source is gone and its keys must not be reused.
+        if cached is not None:
+            print(f"Using cached keys for {url}: {exc}", file=sys.stderr)
+            return cached
+        raise RuntimeError(f"Failed to fetch keys from {url}: {exc}") from exc
+
+    _write_cache(cache_path, body)
+    if etag:
+        _write_cache(etag_path, etag)
+    else:
+        try:
+            etag_path.unlink()
+        except OSError:
+            pass
+    return body
+
+
+def fetch_remote_keys(url: str) -> List[str]:
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    cache_path = KEY_CACHE_DIR / digest
+    body = _read_cache(cache_path, KEY_CACHE_TTL)
+    if body is None:
+        body = _download_keys(url, cache_path, KEY_CACHE_DIR / f"{digest}.etag")
 
     return [line.strip() for line in body.splitlines() if line.strip()]
 
 
-def install_authorized_keys(username: str, keys: Iterable[str]) -> None:
-    user_info = pwd.getpwnam(username)
+_KEY_FETCHES: Dict[str, Future] = {}
+_KEY_FETCHES_LOCK = threading.Lock()
+
+
+def _fetch_cached(url: str) -> Tuple[str, ...]:
+    # Users frequently share key sources and are provisioned concurrently, so
+    # the memo holds the in-flight fetch: later callers wait for it rather
+    # than starting another download.  Failures are dropped from the memo so
+    # the next caller retries.
+    with _KEY_FETCHES_LOCK:
+        future = _KEY_FETCHES.get(url)
+        owner = future is None
+        if owner:
+            future = Future()
+            _KEY_FETCHES[url] = future
+
+    if owner:
+        try:
+            future.set_result(tuple(fetch_remote_keys(url)))
+        except BaseException as exc:
+            with _KEY_FETCHES_LOCK:
+                del _KEY_FETCHES[url]
+            future.set_exception(exc)
+    return future.result()
+
+
+def _ensure_ownership(path: Path, uid: int, gid: int, mode: Optional[int] = None) -> None:
+    # Only issue chown/chmod when the current metadata differs, so re-runs
+    # cost a single stat per path.
+    current = os.stat(path)
+    if current.st_uid != uid or current.st_gid != gid:
+        os.chown(path, uid, gid)
+    if mode is not None and stat.S_IMODE(current.st_mode) != mode:
+        os.chmod(path, mode)
+
+
+def install_authorized_keys(user_info: pwd.struct_passwd, keys: Iterable[str]) -> None:
     home = Path(user_info.pw_dir)
     ssh_dir = home / ".ssh"
     ssh_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
 
     authorized_keys_path = ssh_dir / "authorized_keys"
-    existing_keys: List[str] = []
-    if authorized_keys_path.exists():
-        existing_keys = [
-            line.strip()
-            for line in authorized_keys_path.read_text(encoding="utf-8").splitlines()
-            if line.strip()
-        ]
+    existing_keys: Set[str] = set()
+    file_exists = True
+    missing_newline = False
+    try:
+        with authorized_keys_path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                stripped = line.strip()
+                if stripped:
+                    existing_keys.add(stripped)
+                missing_newline = not line.endswith("\n")
+    except FileNotFoundError:
+        file_exists = False
+
+    new_keys: List[str] = []
+    for key in keys:
+        if not isinstance(key, str):
+            continue
+        key = key.strip()
+        if key and key not in existing_keys:
+            existing_keys.add(key)
+            new_keys.append(key)
 
-    incoming_keys = [key.strip() for key in keys if isinstance(key, str) and key.strip()]
+    # Existing entries are left untouched; only unseen keys are appended.
+    if new_keys or not file_exists:
+        with authorized_keys_path.open("a", encoding="utf-8") as handle:
+            if missing_newline:
+                handle.write("\n")
+            handle.writelines(key + "\n" for key in new_keys)
 
-    merged: List[str] = []
-    seen: Set[str] = set()
-    for key in existing_keys + incoming_keys:
-        if key and key not in seen:
-            seen.add(key)
-            merged.append(key)
-
-    output = "\n".join(merged)
-    if output:
-        output += "\n"
-    authorized_keys_path.write_text(output, encoding="utf-8")
-    existing_keys: Set[str] = set()
-    if authorized_keys_path.exists():
-        existing_keys = {line.strip() for line in authorized_keys_path.read_text(encoding="utf-8").splitlines() if line.strip()}
+    _ensure_ownership(ssh_dir, user_info.pw_uid, user_info.pw_gid)
+    _ensure_ownership(authorized_keys_path, user_info.pw_uid, user_info.pw_gid, 0o600)
+
+
+def _service_names(services: Iterable[str]) -> List[str]:
+    return [service.strip() for service in services if isinstance(service, str) and service.strip()]
 
-    new_keys = existing_keys.union(keys)
-    authorized_keys_path.write_text("\n".join(sorted(new_keys)) + "\n", encoding="utf-8")
-    os.chown(ssh_dir, user_info.pw_uid, user_info.pw_gid)
-    os.chown(authorized_keys_path, user_info.pw_uid, user_info.pw_gid)
-    os.chmod(authorized_keys_path, 0o600)
+
+def _systemctl(action: str, names: List[str]) -> None:
+    result = subprocess.run(["systemctl", action, *names], check=False)
+    if result.returncode != 0 and len(names) > 1:
+        # One bad unit fails the whole batch; retry individually so the
+        # remaining units are still handled.
+        for name in names:
+            subprocess.run(["systemctl", action, name], check=False)
 
 
 def enable_services(services: Iterable[str]) -> None:
-    for service in services:
-        service = service.strip()
-        if not service:
-            continue
-        subprocess.run(["systemctl", "enable", service], check=False)
-        subprocess.run(["systemctl", "start", service], check=False)
+    names = _service_names(services)
+    if not names:
+        return
+    _systemctl("enable", names)
+    _systemctl("start", names)
 
 
 def disable_services(services: Iterable[str]) -> None:
-    for service in services:
-        service = service.strip()
-        if not service:
-            continue
-        subprocess.run(["systemctl", "disable", service], check=False)
-        subprocess.run(["systemctl", "stop", service], check=False)
+    names = _service_names(services)
+    if not names:
+        return
+    _systemctl("disable", names)
+    _systemctl("stop", names)
 
 
 def install_packages(packages: Iterable[str]) -> None:
@@ -242,8 +383,14 @@ def record_target_disk(target_path: Path) -> Optional[str]:
     if not disk:
         return None
 
-    target_path.parent.mkdir(parents=True, exist_ok=True)
-    target_path.write_text(disk + "\n", encoding="utf-8")
+    content = disk + "\n"
+    try:
+        unchanged = target_path.read_text(encoding="utf-8") == content
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        target_path.write_text(content, encoding="utf-8")
     return disk
 
 
@@ -277,12 +424,18 @@ def run(config_path: Path) -> None:
     packages = config.get("packages", [])
     install_packages(packages if isinstance(packages, list) else [])
 
-    for user in config.get("users", []):
-        if not isinstance(user, dict):
-            continue
-        if "username" not in user:
-            continue
-        ensure_user(user)
+    extra_groups = ["sudo"]
+    if _group_exists("wheel"):
+        extra_groups.append("wheel")
+    users = [
+        user for user in config.get("users", []) if isinstance(user, dict) and "username" in user
+    ]
+    if users:
+        # Key downloads for one user overlap with account creation for another.
+        with ThreadPoolExecutor(max_workers=min(4, len(users))) as executor:
+            futures = [executor.submit(ensure_user, user, extra_groups) for user in users]
+            for future in futures:
+                future.result()
 
     services = config.get("services", {}) if isinstance(config.get("services"), dict) else {}
     enable_services(services.get("enable", []))
@@ -1,9 +1,27 @@
 """Utilities for building and provisioning custom openSUSE images."""
 # Copyright (c) 2025 Darren Soothill
 
+import importlib as _importlib
+from types import ModuleType as _ModuleType
+from typing import List as _List
+
 __all__ = [
     "config",
     "network",
     "overlay",
     "simple_config",
 ]
+
+
+def __getattr__(name: str) -> _ModuleType:
+    # Submodules are imported on first attribute access (PEP 562) so callers
+    # only pay for the helpers they use.  Python 3.6 ignores this hook; there
+    # the submodules must be imported explicitly, as before.
+    if name in __all__:
+        return _importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> _List[str]:
+    names = {name for name in globals() if name[:2] == "__" or name in __all__}
+    return sorted(names | set(__all__))
@@ -1,14 +1,18 @@
 """Configuration loading and validation helpers."""
 
 import json
+import os
 import re
-
-import json
 import shutil
 import subprocess
 from pathlib import Path
 from typing import Iterable, Iterator, List, Mapping, MutableMapping, Sequence
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib decoder is used instead
+    orjson = None
+
 
 class ConfigError(RuntimeError):
     """Raised when a configuration file cannot be processed."""
@@ -20,8 +24,11 @@ JsonMapping = MutableMapping[str, object]
 def load_config(path: Path) -> JsonMapping:
     """Load the JSON configuration file located at *path*."""
     try:
-        with path.open("r", encoding="utf-8") as handle:
-            data = json.load(handle)
+        if orjson is not None:
+            data = orjson.loads(path.read_bytes())
+        else:
+            with path.open("r", encoding="utf-8") as handle:
+                data = json.load(handle)
     except FileNotFoundError as exc:
         raise ConfigError(f"Configuration file '{path}' does not exist") from exc
     except json.JSONDecodeError as exc:
@@ -54,6 +61,26 @@ def _chunked(values: Sequence[str], size: int) -> Iterator[Sequence[str]]:
         yield values[index : index + size]
 
 
+def _argument_budget() -> int:
+    try:
+        limit = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        limit = -1
+    if limit <= 0:
+        limit = 131072
+    return limit // 2
+
+
+def _package_batches(command: Sequence[str], packages: Sequence[str]) -> Iterator[Sequence[str]]:
+    """Yield *packages* in as few batches as the argument limit allows."""
+    length = sum(len(arg) + 1 for arg in command) + sum(len(pkg) + 1 for pkg in packages)
+    if length <= _argument_budget():
+        yield packages
+        return
+    for chunk in _chunked(packages, 500):
+        yield chunk
+
+
 _MISSING_RE = re.compile(r"Package '([^']+)' not found\.\s*", re.IGNORECASE)
 
 
@@ -77,9 +104,10 @@ def validate_packages(packages: Iterable[object]) -> List[str]:
     if shutil.which("zypper") is None:
         raise ConfigError("zypper not found on the host; package validation cannot continue")
 
+    base_command = ["zypper", "--non-interactive", "--no-refresh", "info"]
     missing: List[str] = []
-    for chunk in _chunked(pkg_list, 25):
-        command = ["zypper", "--non-interactive", "--no-refresh", "info", *chunk]
+    for chunk in _package_batches(base_command, pkg_list):
+        command = [*base_command, *chunk]
         print("Validating packages with:", " ".join(command))
         result = subprocess.run(
             command,
@@ -101,6 +129,20 @@ def validate_packages(packages: Iterable[object]) -> List[str]:
     return pkg_list
 
 
+def encode_json(data: object, trailing_newline: bool = False) -> bytes:
+    """Serialise *data* as UTF-8 JSON indented by two spaces."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2
+        if trailing_newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+        return orjson.dumps(data, option=option)
+
+    text = json.dumps(data, indent=2, ensure_ascii=False)
+    if trailing_newline:
+        text += "\n"
+    return text.encode("utf-8")
+
+
 def merge_overlay_config(base: JsonMapping, network: Mapping[str, object]) -> JsonMapping:
     """Return a copy of *base* that includes the network block."""
     merged = dict(base)
@@ -112,6 +154,7 @@ __all__ = [
     "ConfigError",
     "JsonMapping",
     "load_config",
+    "encode_json",
     "validate_packages",
     "merge_overlay_config",
 ]
@@ -1,10 +1,19 @@
 """Network discovery utilities."""
 # Copyright (c) 2025 Darren Soothill
 
+import functools
 import json
+import re
+import socket
 import subprocess
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+except ImportError:  # pyroute2 is optional; the ``ip`` command is used instead
+    IPRoute = None
 
 
 class NetworkError(RuntimeError):
@@ -14,7 +23,33 @@ class NetworkError(RuntimeError):
 NetworkInfo = Dict[str, object]
 
 
-def _load_default_routes(strict: bool) -> List[Dict[str, object]]:
+def _netlink_default_routes() -> Tuple[Dict[str, object], ...]:
+    routes: List[Dict[str, object]] = []
+    with IPRoute() as ipr:
+        for route in ipr.get_default_routes(family=socket.AF_INET):
+            entry: Dict[str, object] = {}
+            oif = route.get_attr("RTA_OIF")
+            if oif is not None:
+                links = ipr.get_links(oif)
+                if links:
+                    entry["dev"] = links[0].get_attr("IFLA_IFNAME")
+            gateway = route.get_attr("RTA_GATEWAY")
+            if gateway:
+                entry["gateway"] = gateway
+            routes.append(entry)
+    return tuple(routes)
+
+
+@functools.lru_cache(maxsize=None)
+def _query_default_routes() -> Tuple[Dict[str, object], ...]:
+    # Cached for the lifetime of the process so interface and gateway
+    # detection share a single query; failures are not cached.
+    if IPRoute is not None:
+        try:
+            return _netlink_default_routes()
+        except (NetlinkError, OSError):
+            pass
+
     try:
         result = subprocess.run(
             ["ip", "-json", "route", "show", "default"],
@@ -24,33 +59,33 @@ def _load_default_routes(strict: bool) -> List[Dict[str, object]]:
             check=False,
         )
     except FileNotFoundError as exc:
-        if strict:
-            raise NetworkError(f"Unable to query default routes: {exc}") from exc
-        return []
+        raise NetworkError(f"Unable to query default routes: {exc}") from exc
 
     if result.returncode != 0:
-        if strict:
-            message = result.stderr.strip() or f"exit status {result.returncode}"
-            raise NetworkError(f"Unable to query default routes: {message}")
-        return []
+        message = result.stderr.strip() or f"exit status {result.returncode}"
+        raise NetworkError(f"Unable to query default routes: {message}")
+
+    if not result.stdout.strip():
+        return ()
 
     try:
-        data = json.loads(result.stdout or "[]")
+        data = json.loads(result.stdout)
     except json.JSONDecodeError as exc:
-        if strict:
-            raise NetworkError(f"Failed to parse default route information: {exc}") from exc
-        return []
+        raise NetworkError(f"Failed to parse default route information: {exc}") from exc
 
     if not isinstance(data, list):
-        if strict:
-            raise NetworkError("Unexpected format received from default route query")
-        return []
+        raise NetworkError("Unexpected format received from default route query")
+
+    return tuple(entry for entry in data if isinstance(entry, dict))
+
 
-    filtered: List[Dict[str, object]] = []
-    for entry in data:
-        if isinstance(entry, dict):
-            filtered.append(entry)
-    return filtered
+def _load_default_routes(strict: bool) -> Sequence[Dict[str, object]]:
+    try:
+        return _query_default_routes()
+    except NetworkError:
+        if strict:
+            raise
+        return ()
 
 
 def _extract_route_field(routes: Iterable[Dict[str, object]], field: str) -> Optional[str]:
@@ -62,11 +97,17 @@ def _extract_route_field(routes: Iterable[Dict[str, object]], field: str) -> Opt
 
 
 def detect_default_interface_and_gateway() -> Tuple[str, Optional[str]]:
-    routes = _load_default_routes(strict=True)
-    interface = _extract_route_field(routes, "dev")
+    interface: Optional[str] = None
+    gateway: Optional[str] = None
+    for entry in _load_default_routes(strict=True):
+        if not interface and entry.get("dev"):
+            interface = str(entry["dev"])
+        if not gateway and entry.get("gateway"):
+            gateway = str(entry["gateway"])
+        if interface and gateway:
+            break
     if not interface:
         raise NetworkError("No default network interface detected")
-    gateway = _extract_route_field(routes, "gateway")
     return interface, gateway
 
 
@@ -80,19 +121,31 @@ def detect_default_gateway() -> Optional[str]:
     return _extract_route_field(routes, "gateway")
 
 
+_NAMESERVER_RE = re.compile(r"^[ \t]*nameserver[ \t]+(\S+)[ \t]*$", re.MULTILINE)
+
+
 def read_resolv_conf(path: Path = Path("/etc/resolv.conf")) -> List[str]:
-    if not path.exists():
+    try:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+    except FileNotFoundError:
         return []
+    return _NAMESERVER_RE.findall(text)
 
-    servers: List[str] = []
-    for line in path.read_text(encoding="utf-8", errors="ignore").splitlines():
-        parts = line.split()
-        if len(parts) == 2 and parts[0] == "nameserver":
-            servers.append(parts[1])
-    return servers
 
+def _netlink_interface_address(interface: str) -> Tuple[object, object, object]:
+    with IPRoute() as ipr:
+        indices = ipr.link_lookup(ifname=interface)
+        if not indices:
+            raise NetworkError(f"Unable to inspect interface {interface}: no such device")
+        links = ipr.get_links(indices[0])
+        mtu = links[0].get_attr("IFLA_MTU") if links else None
+        for entry in ipr.get_addr(family=socket.AF_INET, index=indices[0]):
+            address = entry.get_attr("IFA_LOCAL") or entry.get_attr("IFA_ADDRESS")
+            return address, entry.get("prefixlen"), mtu
+    raise NetworkError(f"Interface {interface} has no IPv4 configuration")
 
-def _build_interface_config(interface: str, gateway: Optional[str]) -> NetworkInfo:
+
+def _ip_interface_address(interface: str) -> Tuple[object, object, object]:
     try:
         result = subprocess.run(
             ["ip", "-json", "addr", "show", "dev", interface],
@@ -104,7 +157,7 @@ def _build_interface_config(interface: str, gateway: Optional[str]) -> NetworkIn
     except (FileNotFoundError, subprocess.CalledProcessError) as exc:
         raise NetworkError(f"Unable to inspect interface {interface}: {exc}") from exc
 
-    addr_info = json.loads(result.stdout or "[]")
+    addr_info = json.loads(result.stdout) if result.stdout.strip() else []
     if not addr_info:
         raise NetworkError(f"Interface {interface} has no address information")
 
@@ -116,8 +169,21 @@ def _build_interface_config(interface: str, gateway: Optional[str]) -> NetworkIn
     if not inet_entry:
         raise NetworkError(f"Interface {interface} has no IPv4 configuration")
 
-    address = inet_entry.get("local")
-    prefixlen = inet_entry.get("prefixlen")
+    return inet_entry.get("local"), inet_entry.get("prefixlen"), data.get("mtu")
+
+
+def _interface_address(interface: str) -> Tuple[object, object, object]:
+    """Return the IPv4 address, prefix length and MTU of *interface*."""
+    if IPRoute is not None:
+        try:
+            return _netlink_interface_address(interface)
+        except (NetlinkError, OSError):
+            pass
+    return _ip_interface_address(interface)
+
+
+def _build_interface_config(interface: str, gateway: Optional[str]) -> NetworkInfo:
+    address, prefixlen, mtu = _interface_address(interface)
     if not address or prefixlen is None:
         raise NetworkError(
             f"Incomplete IPv4 configuration detected for interface {interface}"
@@ -129,7 +195,7 @@ def _build_interface_config(interface: str, gateway: Optional[str]) -> NetworkIn
         "prefixlen": prefixlen,
         "gateway": gateway,
         "dns": read_resolv_conf(),
-        "mtu": data.get("mtu"),
+        "mtu": mtu,
     }
 
 
@@ -143,25 +209,19 @@ def gather_interface_config_with_gateway(interface: str, gateway: Optional[str])
 
 def render_ifcfg(network: NetworkInfo) -> str:
     dns = " ".join(str(value) for value in network.get("dns", []) if value)
-    gateway = network.get("gateway")
-    mtu = network.get("mtu")
-
-    lines = [
-        f"DEVICE='{network['interface']}'",
-        "BOOTPROTO='static'",
-        "STARTMODE='auto'",
-        "ONBOOT='yes'",
-        "DEFROUTE='yes'",
-        "PEERDNS='no'",
-        f"IPADDR='{network['address']}/{network['prefixlen']}'",
-    ]
-    if gateway:
-        lines.append(f"GATEWAY='{gateway}'")
-    if dns:
-        lines.append(f"DNS='{dns}'")
-    if mtu:
-        lines.append(f"MTU='{mtu}'")
-    return "\n".join(lines) + "\n"
+    fields = (
+        ("DEVICE", network["interface"]),
+        ("BOOTPROTO", "static"),
+        ("STARTMODE", "auto"),
+        ("ONBOOT", "yes"),
+        ("DEFROUTE", "yes"),
+        ("PEERDNS", "no"),
+        ("IPADDR", f"{network['address']}/{network['prefixlen']}"),
+        ("GATEWAY", network.get("gateway") or None),
+        ("DNS", dns or None),
+        ("MTU", network.get("mtu") or None),
+    )
+    return "\n".join(f"{key}='{value}'" for key, value in fields if value is not None) + "\n"
 
 
 __all__ = [
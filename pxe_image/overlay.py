@@ -1,35 +1,65 @@
 """Helpers for rendering the overlay filesystem used during the build."""
 # Copyright (c) 2025 Darren Soothill
 
-import json
+import os
 import shutil
 from pathlib import Path
 from typing import Mapping
 
-from .config import JsonMapping, merge_overlay_config
+from .config import JsonMapping, encode_json, merge_overlay_config
 from .network import NetworkInfo, render_ifcfg
 
 
+_NETWORK_PLACEHOLDER = "@@pxe-image:network@@"
+
+
+def _encode_overlay_config(config: JsonMapping, network: Mapping[str, object], network_json: bytes) -> bytes:
+    # merge_overlay_config only adds a top-level "network" key, so encode the
+    # config around a placeholder and splice in the already encoded network
+    # block, indented one level, instead of serialising it a second time.
+    merged = dict(config)
+    merged["network"] = _NETWORK_PLACEHOLDER
+    skeleton = encode_json(merged)
+    marker = encode_json(_NETWORK_PLACEHOLDER)
+    if skeleton.count(marker) != 1:
+        return encode_json(merge_overlay_config(config, network))
+    return skeleton.replace(marker, network_json.replace(b"\n", b"\n  "))
+
+
 def prepare_overlay_root(path: Path) -> None:
-    if path.exists():
-        shutil.rmtree(path)
+    try:
+        with os.scandir(path) as entries:
+            empty = next(entries, None) is None
+        if not empty:
+            shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
     path.mkdir(parents=True, exist_ok=True)
 
 
-def write_overlay(overlay_root: Path, config: JsonMapping, network: Mapping[str, object]) -> None:
+def write_overlay(
+    overlay_root: Path,
+    config: JsonMapping,
+    network: Mapping[str, object],
+    splice_network: bool = True,
+) -> None:
     opt_dir = overlay_root / "opt/custom"
-    opt_dir.mkdir(parents=True, exist_ok=True)
-    rendered_config = merge_overlay_config(config, network)
-    (opt_dir / "config.json").write_text(json.dumps(rendered_config, indent=2), encoding="utf-8")
-
     network_dir = overlay_root / "etc/sysconfig/network"
-    network_dir.mkdir(parents=True, exist_ok=True)
+    custom_dir = overlay_root / "etc/custom"
+    for directory in (opt_dir, network_dir, custom_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    network_json = encode_json(network)
+    if splice_network:
+        config_json = _encode_overlay_config(config, network, network_json)
+    else:
+        config_json = encode_json(merge_overlay_config(config, network))
+    (opt_dir / "config.json").write_bytes(config_json)
+
     iface_path = network_dir / f"ifcfg-{network['interface']}"
     iface_path.write_text(render_ifcfg(network), encoding="utf-8")
 
-    custom_dir = overlay_root / "etc/custom"
-    custom_dir.mkdir(parents=True, exist_ok=True)
-    (custom_dir / "network.json").write_text(json.dumps(network, indent=2), encoding="utf-8")
+    (custom_dir / "network.json").write_bytes(network_json)
 
 
 __all__ = ["prepare_overlay_root", "write_overlay"]
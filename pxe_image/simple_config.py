@@ -1,10 +1,14 @@
 """Parsers for the text-based configuration inputs."""
 # Copyright (c) 2025 Darren Soothill
 
-import json
-import shlex
+import os
+import re
+import sys
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Match, Optional
+
+from .config import encode_json
 
 
 class RepoSpec(object):
@@ -19,7 +23,7 @@ class RepoSpec(object):
         self.ref = ref
 
 
-def _deduplicate_preserve_order(values: List[str]) -> List[str]:
+def _deduplicate_preserve_order(values: Iterable[str]) -> List[str]:
     seen = set()
     unique: List[str] = []
     for value in values:
@@ -30,48 +34,88 @@ def _deduplicate_preserve_order(values: List[str]) -> List[str]:
 
 
 def read_lines(path: Path) -> List[str]:
-    if not path.exists():
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
         return []
-    return [line.rstrip() for line in path.read_text(encoding="utf-8").splitlines()]
+    return data.decode("utf-8").splitlines()
+
+
+def _parse_simple_list(path: Path) -> List[str]:
+    stripped = (line.strip() for line in read_lines(path))
+    return _deduplicate_preserve_order(
+        value for value in stripped if value and not value.startswith("#")
+    )
 
 
 def parse_packages(path: Path) -> List[str]:
-    packages: List[str] = []
-    for line in read_lines(path):
-        stripped = line.strip()
-        if not stripped or stripped.startswith("#"):
-            continue
-        packages.append(stripped)
-    return _deduplicate_preserve_order(packages)
+    return _parse_simple_list(path)
 
 
 def parse_services(path: Path) -> List[str]:
-    services: List[str] = []
-    for line in read_lines(path):
-        stripped = line.strip()
-        if not stripped or stripped.startswith("#"):
-            continue
-        services.append(stripped)
-    return _deduplicate_preserve_order(services)
+    return _parse_simple_list(path)
 
 
-def parse_repo_spec(spec: str, lineno: int) -> RepoSpec:
-    ref = "main"
-    if "@" in spec:
-        spec, ref = spec.rsplit("@", 1)
-        ref = ref or "main"
-    path = "authorized_keys"
-    if ":" in spec:
-        repo_part, path = spec.split(":", 1)
-        path = path or "authorized_keys"
+def _parse_repo_token(spec: str, lineno: int) -> Dict[str, object]:
+    head, at, ref = spec.rpartition("@")
+    if at:
+        spec, ref = head, ref or "main"
     else:
-        repo_part = spec
-    if "/" not in repo_part:
+        ref = "main"
+    repo_part, _, path = spec.partition(":")
+    path = path or "authorized_keys"
+    owner, slash, repo = repo_part.partition("/")
+    if not slash:
         raise ValueError(f"Line {lineno}: repository specification '{spec}' must include owner/repo")
-    owner, repo = repo_part.split("/", 1)
     if not owner or not repo:
         raise ValueError(f"Line {lineno}: repository specification '{spec}' is invalid")
-    return RepoSpec(owner=owner, repo=repo, path=path, ref=ref)
+    # Owners, paths and refs repeat across users; share one string per value.
+    return {
+        "type": "repo",
+        "owner": sys.intern(owner),
+        "repo": repo,
+        "path": sys.intern(path),
+        "ref": sys.intern(ref),
+    }
+
+
+def parse_repo_spec(spec: str, lineno: int) -> RepoSpec:
+    entry = _parse_repo_token(spec, lineno)
+    return RepoSpec(
+        owner=str(entry["owner"]),
+        repo=str(entry["repo"]),
+        path=str(entry["path"]),
+        ref=str(entry["ref"]),
+    )
+
+
+_PASSWORD_SENTINELS = frozenset({"-", "none", "null"})
+
+
+# A token is a run of unquoted characters and complete '...' or "..." segments;
+# an unquoted '#' starts a comment.  Backslash escapes are not supported.
+_TOKEN_RE = re.compile(r"""(?P<comment>\#.*)|(?P<word>(?:[^\s"'\#]+|"[^"]*"|'[^']*')+)|(?P<quote>["'])""")
+_QUOTED_RE = re.compile(r""""([^"]*)"|'([^']*)'""")
+
+
+def _unquote(match: Match[str]) -> str:
+    double, single = match.groups()
+    return double if double is not None else single
+
+
+def _tokenize(line: str, lineno: int) -> List[str]:
+    tokens: List[str] = []
+    for match in _TOKEN_RE.finditer(line):
+        word = match.group("word")
+        if word is not None:
+            if '"' in word or "'" in word:
+                word = _QUOTED_RE.sub(_unquote, word)
+            tokens.append(word)
+        elif match.group("quote") is not None:
+            raise ValueError(f"Line {lineno}: no closing quotation")
+        else:
+            break
+    return tokens
 
 
 def ensure_user_defaults(user: Dict[str, object]) -> None:
@@ -79,8 +123,45 @@ def ensure_user_defaults(user: Dict[str, object]) -> None:
     user.setdefault("shell", "/bin/bash")
 
 
+_AttributeHandler = Callable[[Dict[str, object], str, str, int], None]
+
+
+def _set_string_attr(user: Dict[str, object], key: str, value: str, lineno: int) -> None:
+    user[key] = value
+
+
+def _set_shared_attr(user: Dict[str, object], key: str, value: str, lineno: int) -> None:
+    user[key] = sys.intern(value)
+
+
+def _set_int_attr(user: Dict[str, object], key: str, value: str, lineno: int) -> None:
+    try:
+        user[key] = int(value)
+    except ValueError as exc:
+        raise ValueError(f"Line {lineno}: {key} must be an integer") from exc
+
+
+def _add_github_user(user: Dict[str, object], key: str, value: str, lineno: int) -> None:
+    user["github_keys"].append({"type": "user", "user": value})
+
+
+def _add_github_url(user: Dict[str, object], key: str, value: str, lineno: int) -> None:
+    user["github_keys"].append({"type": "url", "url": value})
+
+
+_ATTR_HANDLERS: Dict[str, _AttributeHandler] = {
+    "gecos": _set_string_attr,
+    "shell": _set_shared_attr,
+    "home": _set_string_attr,
+    "uid": _set_int_attr,
+    "gid": _set_int_attr,
+    "github_user": _add_github_user,
+    "github_url": _add_github_url,
+}
+
+
 def parse_user_line(line: str, lineno: int) -> Dict[str, object]:
-    tokens = shlex.split(line, comments=True, posix=True)
+    tokens = _tokenize(line, lineno)
     if not tokens:
         raise ValueError(f"Line {lineno}: empty user definition")
     if len(tokens) < 3:
@@ -88,57 +169,39 @@ def parse_user_line(line: str, lineno: int) -> Dict[str, object]:
             f"Line {lineno}: expected 'username password repo[:path][@ref] [additional ...]'"
         )
 
-    username = tokens[0]
     raw_password = tokens[1]
-    password_is_hashed = False
-    if raw_password in {"-", "none", "null"}:
-        password: Optional[str] = None
-    elif raw_password.startswith("hash:"):
-        password = raw_password.split(":", 1)[1]
-        password_is_hashed = True
+    password: Optional[str]
+    if raw_password in _PASSWORD_SENTINELS:
+        password, hashed = None, False
+    elif raw_password[:5] == "hash:":
+        password, hashed = raw_password[5:], True
     else:
-        password = raw_password
+        password, hashed = raw_password, False
 
+    github_keys: List[Dict[str, object]] = []
     user: Dict[str, object] = {
-        "username": username,
-        "github_keys": [],
+        "username": tokens[0],
+        "github_keys": github_keys,
     }
     if password:
-        user["password"] = password
-        if password_is_hashed:
-            user["password_is_hashed"] = True
+        if hashed:
+            user.update(password=password, password_is_hashed=True)
+        else:
+            user["password"] = password
 
     for token in tokens[2:]:
         if "=" in token:
             key, value = token.split("=", 1)
             key = key.strip()
             value = value.strip()
-            if key in {"gecos", "shell", "home"}:
-                user[key] = value
-            elif key in {"uid", "gid"}:
-                try:
-                    user[key] = int(value)
-                except ValueError as exc:
-                    raise ValueError(f"Line {lineno}: {key} must be an integer") from exc
-            elif key == "github_user":
-                user.setdefault("github_keys", []).append({"type": "user", "user": value})
-            elif key == "github_url":
-                user.setdefault("github_keys", []).append({"type": "url", "url": value})
-            else:
+            handler = _ATTR_HANDLERS.get(key)
+            if handler is None:
                 raise ValueError(f"Line {lineno}: unsupported attribute '{key}'")
+            handler(user, key, value, lineno)
         else:
-            repo_spec = parse_repo_spec(token, lineno)
-            user.setdefault("github_keys", []).append(
-                {
-                    "type": "repo",
-                    "owner": repo_spec.owner,
-                    "repo": repo_spec.repo,
-                    "path": repo_spec.path,
-                    "ref": repo_spec.ref,
-                }
-            )
-
-    if not user["github_keys"]:
+            github_keys.append(_parse_repo_token(token, lineno))
+
+    if not github_keys:
         raise ValueError(f"Line {lineno}: at least one GitHub key source must be provided")
 
     ensure_user_defaults(user)
@@ -146,12 +209,17 @@ def parse_user_line(line: str, lineno: int) -> Dict[str, object]:
 
 
 def parse_users(path: Path) -> List[Dict[str, object]]:
+    try:
+        data = path.read_bytes().decode("utf-8")
+    except FileNotFoundError:
+        return []
+
     users: List[Dict[str, object]] = []
-    for lineno, line in enumerate(read_lines(path), start=1):
+    for lineno, line in enumerate(data.splitlines(), start=1):
         stripped = line.strip()
-        if not stripped or stripped.startswith("#"):
+        if not stripped or stripped[0] == "#":
             continue
-        users.append(parse_user_line(line, lineno))
+        users.append(parse_user_line(stripped, lineno))
     return users
 
 
@@ -173,9 +241,59 @@ def render_from_files(users: Path, packages: Path, services: Path) -> Dict[str,
     return render_config(parsed_users, parsed_packages, parsed_services)
 
 
-def dump_config(config: Dict[str, object], destination: Path) -> None:
+@contextmanager
+def _atomic_output(destination: Path) -> Iterator[BinaryIO]:
+    # Write next to the destination and rename over it so readers never see
+    # a partially written file.
     destination.parent.mkdir(parents=True, exist_ok=True)
-    destination.write_text(json.dumps(config, indent=2) + "\n", encoding="utf-8")
+    tmp = destination.with_suffix(destination.suffix + ".tmp")
+    try:
+        with tmp.open("wb") as handle:
+            yield handle
+        os.replace(str(tmp), str(destination))
+    except BaseException:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def dump_config(config: Dict[str, object], destination: Path) -> None:
+    with _atomic_output(destination) as handle:
+        handle.write(encode_json(config, trailing_newline=True))
+
+
+def _encode_nested(data: object, depth: int) -> bytes:
+    # encode_json escapes newlines inside strings, so every raw newline is
+    # structural and can be re-indented to the nesting depth.
+    return encode_json(data).replace(b"\n", b"\n" + b"  " * depth)
+
+
+def write_config_streaming(
+    users: List[Dict[str, object]], packages: List[str], services: List[str], destination: Path
+) -> None:
+    """Write the rendered configuration section by section.
+
+    The output is byte-for-byte what ``dump_config(render_config(...))``
+    produces, but only one section (or one user) is serialised at a time.
+    """
+    with _atomic_output(destination) as handle:
+        handle.write(b'{\n  "packages": ')
+        handle.write(_encode_nested(packages, 1))
+        handle.write(b',\n  "services": ')
+        handle.write(_encode_nested({"enable": services, "disable": []}, 1))
+        handle.write(b',\n  "users": ')
+        if users:
+            separator = b"[\n    "
+            for user in users:
+                handle.write(separator)
+                handle.write(_encode_nested(user, 2))
+                separator = b",\n    "
+            handle.write(b"\n  ]")
+        else:
+            handle.write(b"[]")
+        handle.write(b"\n}\n")
 
 
 __all__ = [
@@ -187,4 +305,5 @@ __all__ = [
     "parse_users",
     "render_config",
     "render_from_files",
+    "write_config_streaming",
 ]